@@ -8,7 +8,27 @@ import os
 import logging
 import warnings
 import traceback
+import shlex
+import hashlib
+import tempfile
+import gzip
+import shutil
 from collections import OrderedDict
+try:
+    from shutil import which as _which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as _which
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the 'futures' backport, so all codes are run serially
+    ThreadPoolExecutor = None
+
+from astropy.io import fits
+from astropy.io.votable import parse
+from astropy.table import vstack
+from astropy.utils import minversion
 
 logger = logging.getLogger('astromatic.api')
 
@@ -25,6 +45,82 @@ codes = {
     #'WeightWatcher': 'ww'
 }
 
+# Command line values of boolean config parameters
+_config_bools = {True: 'Y', False: 'N'}
+
+# Config parameters that usually change every time a code is run in a pipeline
+# step (such as filenames), so they are filled in separately from the cached
+# command line arguments of the other parameters
+_varying_params = set(['CATALOG_NAME', 'XML_NAME', 'FLAG_IMAGE', 'WEIGHT_IMAGE',
+    'IMAGEOUT_NAME', 'WEIGHTOUT_NAME', 'REFOUT_CATPATH', 'PARAMETERS_NAME'])
+# Config parameters whose values are changed for each frame in `Astromatic.run_frames`
+_frame_params = set(['-FLAG_IMAGE', '-WEIGHT_IMAGE', '-XML_NAME'])
+# Command line arguments for each set of config parameters used by `_get_config_args`
+_config_args_cache = {}
+_config_args_cache_size = 256
+
+# Argument lists (with the full path of the executable) for each command
+_resolved_cmds = {}
+
+# Versions of each command that has been run by `Astromatic.get_version`
+_versions = {}
+
+# Sometimes the xml files do not fit the VOTABLE standard, so the votable parser is
+# told to ignore the problems (astropy 4.0 replaced ``pedantic`` with ``verify``)
+if minversion('astropy', '4.0'):
+    _parse_kwargs = {'invalid': 'mask', 'verify': 'ignore'}
+else:
+    _parse_kwargs = {'invalid': 'mask', 'pedantic': False}
+
+def _prep_api_kwargs(pipeline, step_id, code, xml_suffix, api_kwargs, defaults=[],
+        build_name=None):
+    """
+    Set the keyword arguments used to initialize an `Astromatic` object in a
+    pipeline step that were not specified by the user.
+    
+    Parameters
+    ----------
+    pipeline: `astromatic_wrapper.utils.pipeline.Pipeline`
+        Pipeline containing parameters that may be necessary to set certain 
+        AstrOmatic configuration parameters
+    step_id: str
+        Unique identifier for the current step in the pipeline
+    code: str
+        Name of the astromatic code to run
+    xml_suffix: str
+        Suffix of the xml log file name (for example ``'sex'`` gives the xml file
+        '{step_id}.sex.log.xml')
+    api_kwargs: dict
+        Keyword arguments specified by the user. This is not modified.
+    defaults: list of tuples (optional)
+        List of ``(key, value)`` pairs to add to the ``config`` if the user has
+        not specified them
+    build_name: str (optional)
+        Key of the code in ``pipeline.build_paths``. Defaults to ``code``.
+    
+    Returns
+    -------
+    api_kwargs: dict
+        Copy of ``api_kwargs`` with all of the missing keyword arguments set
+    """
+    if build_name is None:
+        build_name = code
+    api_kwargs = dict(api_kwargs)
+    api_kwargs.setdefault('code', code)
+    if 'cmd' not in api_kwargs and build_name in pipeline.build_paths:
+        api_kwargs['cmd'] = pipeline.build_paths[build_name]
+    if 'temp_path' not in api_kwargs:
+        api_kwargs['temp_path'] = pipeline.paths['temp']
+    config = api_kwargs['config'] = OrderedDict(api_kwargs.get('config', {}))
+    for key, value in defaults:
+        config.setdefault(key, value)
+    log_path = pipeline.paths.get('log')
+    if log_path is not None:
+        config.setdefault('WRITE_XML', 'Y')
+        config.setdefault('XML_NAME', os.path.join(log_path,
+            '{0}.{1}.log.xml'.format(step_id, xml_suffix)))
+    return api_kwargs
+
 def run_sex(pipeline, step_id, files, api_kwargs={}, frames=[]):
     """
     Run SExtractor with a specified set of parameters.
@@ -63,31 +159,19 @@ def run_sex(pipeline, step_id, files, api_kwargs={}, frames=[]):
             If the WRITE_XML parameter is ``True`` then a table of warnings detected
             in the code is returned
     """
-    if 'code' not in api_kwargs:
-        api_kwargs['code'] = 'SExtractor'
-    if 'cmd' not in api_kwargs and 'SExtractor' in pipeline.build_paths:
-        api_kwargs['cmd'] = pipeline.build_paths['SExtractor']
-    if 'temp_path' not in api_kwargs:
-        api_kwargs['temp_path'] = pipeline.paths['temp']
-    if 'config' not in api_kwargs:
-        api_kwargs['config'] = OrderedDict()
-    if 'CATALOG_NAME' not in api_kwargs['config']:
-        api_kwargs['config']['CATALOG_NAME'] = files['image'].replace('.fits', '.cat')
-    if 'FLAG_IMAGE' not in api_kwargs['config'] and 'dqmask' in files:
-        api_kwargs['config']['FLAG_IMAGE'] = files['dqmask']
-    if 'WEIGHT_IMAGE' not in api_kwargs['config'] and 'wtmap' in files:
-        api_kwargs['config']['WEIGHT_IMAGE'] = files['wtmap']
-    if 'log' in pipeline.paths:
-        if 'WRITE_XML' not in api_kwargs['config']:
-            api_kwargs['config']['WRITE_XML'] = 'Y'
-        if 'XML_NAME' not in api_kwargs['config']:
-            api_kwargs['config']['XML_NAME'] = os.path.join(pipeline.paths['log'], 
-                '{0}.sex.log.xml'.format(step_id))
+    defaults = [('CATALOG_NAME', files['image'].replace('.fits', '.cat'))]
+    if 'dqmask' in files:
+        defaults.append(('FLAG_IMAGE', files['dqmask']))
+    if 'wtmap' in files:
+        defaults.append(('WEIGHT_IMAGE', files['wtmap']))
+    api_kwargs = _prep_api_kwargs(pipeline, step_id, 'SExtractor', 'sex', api_kwargs, defaults)
     sex = Astromatic(**api_kwargs)
     if len(frames)==0:
         result = sex.run(files['image'])
     else:
-        result = sex.run_frames(files['image'], 'SExtractor', frames, False)
+        # Frames run serially, since run_sex tasks may already be running in a
+        # run_batch pool
+        result = sex.run_frames(files['image'], 'SExtractor', frames, False, max_workers=1)
     return result
     
 def run_scamp(pipeline, step_id, catalogs, api_kwargs={}, save_catalog=None):
@@ -124,23 +208,12 @@ def run_scamp(pipeline, step_id, catalogs, api_kwargs={}, save_catalog=None):
             If the WRITE_XML parameter is ``True`` then a table of warnings detected
             in the code is returned
     """
-    if 'code' not in api_kwargs:
-        api_kwargs['code'] = 'SCAMP'
-    if 'cmd' not in api_kwargs and 'SCAMP' in pipeline.build_paths:
-        api_kwargs['cmd'] = pipeline.build_paths['SCAMP']
-    if 'temp_path' not in api_kwargs:
-        api_kwargs['temp_path'] = pipeline.paths['temp']
-    if 'config' not in api_kwargs:
-        api_kwargs['config'] = OrderedDict()
     if save_catalog is not None:
-        api_kwargs['config']['SAVE_REFCATALOG'] = 'Y'
-        api_kwargs['config']['REFOUT_CATPATH'] = save_catalog
-    if 'log' in pipeline.paths:
-        if 'WRITE_XML' not in api_kwargs['config']:
-            api_kwargs['config']['WRITE_XML'] = 'Y'
-        if 'XML_NAME' not in api_kwargs['config']:
-            api_kwargs['config']['XML_NAME'] = os.path.join(pipeline.paths['log'], 
-                '{0}.scamp.log.xml'.format(step_id))
+        config = OrderedDict(api_kwargs.get('config', {}))
+        config['SAVE_REFCATALOG'] = 'Y'
+        config['REFOUT_CATPATH'] = save_catalog
+        api_kwargs = dict(api_kwargs, config=config)
+    api_kwargs = _prep_api_kwargs(pipeline, step_id, 'SCAMP', 'scamp', api_kwargs)
     scamp = Astromatic(**api_kwargs)
     result = scamp.run(catalogs)
     return result
@@ -179,29 +252,19 @@ def run_swarp(pipeline, step_id, filenames, api_kwargs, frames=[]):
             If the WRITE_XML parameter is ``True`` then a table of warnings detected
             in the code is returned
     """
-    if 'code' not in api_kwargs:
-        api_kwargs['code'] = 'SWarp'
-    if 'cmd' not in api_kwargs and 'SWARP' in pipeline.build_paths:
-        api_kwargs['cmd'] = pipeline.build_paths['SWARP']
-    if 'temp_path' not in api_kwargs:
-        api_kwargs['temp_path'] = pipeline.paths['temp']
-    if 'config' not in api_kwargs:
-        api_kwargs['config'] = OrderedDict()
-    if 'RESAMPLE_DIR' not in api_kwargs['config']:
-        api_kwargs['config']['RESAMPLE_DIR'] = api_kwargs['temp_path']
+    if 'temp_path' in api_kwargs:
+        defaults = [('RESAMPLE_DIR', api_kwargs['temp_path'])]
+    else:
+        defaults = [('RESAMPLE_DIR', pipeline.paths['temp'])]
     #if 'IMAGEOUT_NAME' not in api_kwargs['config']:
     #    raise PipelineError('Must include a name for the new stacked image')
-    if 'log' in pipeline.paths:
-        if 'WRITE_XML' not in api_kwargs['config']:
-            api_kwargs['config']['WRITE_XML'] = 'Y'
-        if 'XML_NAME' not in api_kwargs['config']:
-            api_kwargs['config']['XML_NAME'] = os.path.join(pipeline.paths['log'], 
-                '{0}.swarp.log.xml'.format(step_id))
+    api_kwargs = _prep_api_kwargs(pipeline, step_id, 'SWarp', 'swarp', api_kwargs, defaults,
+        'SWARP')
     swarp = Astromatic(**api_kwargs)
     if len(frames)==0:
         result = swarp.run(filenames)
     else:
-        result = swarp.run_frames(filenames, 'SWarp', frames, False)
+        result = swarp.run_frames(filenames, 'SWarp', frames, False, max_workers=1)
     return result
     
 def run_psfex(pipeline, step_id, catalogs, api_kwargs={}):
@@ -235,26 +298,59 @@ def run_psfex(pipeline, step_id, catalogs, api_kwargs={}):
             If the WRITE_XML parameter is ``True`` then a table of warnings detected
             in the code is returned
     """
-    if 'code' not in api_kwargs:
-        api_kwargs['code'] = 'PSFEx'
-    if 'cmd' not in api_kwargs and 'PSFEx' in pipeline.build_paths:
-        api_kwargs['cmd'] = pipeline.build_paths['PSFEx']
-    if 'temp_path' not in api_kwargs:
-        api_kwargs['temp_path'] = pipeline.paths['temp']
-    if 'config' not in api_kwargs:
-        api_kwargs['config'] = OrderedDict()
-    if 'PSF_DIR' not in api_kwargs['config']:
-        api_kwargs['config']['PSF_DIR'] = pipeline.paths['temp']
-    if 'log' in pipeline.paths:
-        if 'WRITE_XML' not in api_kwargs['config']:
-            api_kwargs['config']['WRITE_XML'] = 'Y'
-        if 'XML_NAME' not in api_kwargs['config']:
-            api_kwargs['config']['XML_NAME'] = os.path.join(pipeline.paths['log'], 
-                '{0}.psfex.log.xml'.format(step_id))
+    defaults = [('PSF_DIR', pipeline.paths['temp'])]
+    api_kwargs = _prep_api_kwargs(pipeline, step_id, 'PSFEx', 'psfex', api_kwargs, defaults)
     psfex = Astromatic(**api_kwargs)
     result = psfex.run(catalogs)
     return result
 
+def run_batch(tasks, n_workers=1):
+    """
+    Run a set of independent tasks (for example ``run_sex`` on a list of images or
+    ``run_psfex`` on a list of catalogs) at the same time.
+    
+    Each task runs in a separate thread, which spends nearly all of its time waiting
+    for the AstrOmatic code to finish, so the codes for up to ``n_workers`` tasks run
+    in parallel. Tasks that run at the same time must write to different files.
+    A different ``step_id`` only changes the name of the xml log, so each task must
+    also set its own output filenames (for example ``CATALOG_NAME`` for
+    ``run_sex``, ``IMAGEOUT_NAME`` and ``WEIGHTOUT_NAME`` for ``run_swarp``, or
+    ``save_catalog`` for ``run_scamp``), otherwise the tasks overwrite each other.
+    
+    ``run_batch`` does not share its pool with `Astromatic.run_frames`, so tasks that
+    also run frames in parallel would start ``n_workers*max_workers`` codes at once.
+    The ``run_sex`` and ``run_swarp`` tasks always run their frames serially
+    (``max_workers=1``); tasks calling `Astromatic.run_frames` directly should do
+    the same.
+    
+    Parameters
+    ----------
+    tasks: list of tuples
+        List of ``(func, args, kwargs)`` tuples, where ``func`` is called like
+        ``func(*args, **kwargs)``
+    n_workers: int (optional)
+        Maximum number of tasks to run at the same time. The default is ``1``, which
+        runs the tasks one at a time. SExtractor, SCAMP, SWarp and PSFEx use one
+        thread per CPU by default, so when ``n_workers>1`` the ``NTHREADS`` config
+        parameter of each task should also be set (for example to the number of CPUs
+        divided by ``n_workers``) to avoid starting ``n_workers`` threads for every CPU.
+    
+    Returns
+    -------
+    results: list
+        Result returned by each task, in the same order as ``tasks``. If a task raises
+        an exception it is raised by ``run_batch`` after all of the tasks have finished.
+    """
+    if n_workers>1 and ThreadPoolExecutor is None:
+        warnings.warn("Running tasks at the same time requires 'concurrent.futures', "
+            "running the tasks one at a time")
+        n_workers = 1
+    if n_workers==1:
+        return [func(*args, **kwargs) for func, args, kwargs in tasks]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(func, *args, **kwargs) for func, args, kwargs in tasks]
+    return [future.result() for future in futures]
+
 class AstromaticError(Exception):
     pass
 
@@ -263,7 +359,7 @@ class Astromatic:
     Class to hold config options for an Astrometric code. 
     """
     def __init__(self, code, temp_path=None, config={}, config_file=None, store_output=False, 
-            **kwargs):
+            compress_xml=False, verbose=True, **kwargs):
         """
         Initialize a particular astromatic code with a given set of configurations.
         
@@ -283,6 +379,15 @@ class Astromatic:
             If ``store_output`` is ``False``, the output of the code is printed to 
             sys.stdout. If ``store_output`` is ``True`` the output is saved in a variable
             that is returned when the function is run.
+        compress_xml: boolean (optional)
+            If ``compress_xml`` is ``True``, the xml file generated by the code is
+            compressed with gzip after it has been read and the original file is
+            removed. This is useful when the 'log' path is on a network drive.
+            The default is ``False``.
+        verbose: boolean (optional)
+            If ``verbose`` is ``False`` and ``store_output`` is ``False``, the output of
+            the code is discarded instead of being printed to sys.stdout.
+            The default is ``True``.
         """
         self.code = code
         if code not in codes:
@@ -292,6 +397,8 @@ class Astromatic:
         self.config = config
         self.config_file = config_file
         self.store_output = store_output
+        self.compress_xml = compress_xml
+        self.verbose = verbose
         for k, v in kwargs.items():
             setattr(self, k, v)
     
@@ -316,8 +423,9 @@ class Astromatic:
         
         Returns
         -------
-        cmd: str
-            Commandline statement to run the given code
+        cmd: list
+            List of commandline arguments (beginning with the executable) to run
+            the given code
         kwargs: dict
             Dictionary of keyword arguments used in the build
         """
@@ -339,45 +447,65 @@ class Astromatic:
                     raise AstromaticError(
                         "You must either supply a 'PARAMETERS_NAME' in 'config' or "+
                         "a 'temp_path' to store the temporary parameters file")
-                param_name = os.path.join(kwargs['temp_path'], 'sex.param')
-                f = open(param_name, 'w')
-                for p in kwargs['params']:
-                    f.write(p+'\n')
-                f.close()
+                # Each set of parameters is saved to its own file, which is only
+                # written if it doesn't already exist
+                param_str = ''.join([p+'\n' for p in kwargs['params']])
+                param_hash = hashlib.sha1(param_str.encode('utf-8')).hexdigest()[:12]
+                param_name = os.path.join(kwargs['temp_path'], 
+                    'sex-{0}.param'.format(param_hash))
+                if not os.path.exists(param_name):
+                    # Write to a temporary file first so that another process never
+                    # reads a partially written parameter file
+                    fd, tmp_name = tempfile.mkstemp(dir=kwargs['temp_path'], suffix='.param')
+                    with os.fdopen(fd, 'w') as f:
+                        f.write(param_str)
+                    try:
+                        os.rename(tmp_name, param_name)
+                    except OSError:
+                        # Another process already created the file
+                        os.remove(tmp_name)
                 kwargs['config']['PARAMETERS_NAME'] = param_name
             elif 'PARAMETERS_NAME' not in kwargs['config']:
                 raise AstromaticError(
                     "To run SExtractor yo must either supply a 'params' list of parameters "+
                     "or a config keyword 'PARAMETERS_NAME' that points to a parameters file")
         # Get the correct command for the given code (if one is not specified)
-        if 'cmd' not in kwargs:
-            if kwargs['code'] not in codes:
-                raise AstromaticError(
-                    "You must either supply a valid astromatic 'code' name or "+
-                    "a 'cmd' to run")
-            cmd = codes[kwargs['code']]
-        else:
-            cmd = kwargs['cmd']
-        if cmd[-1]!=' ':
-            cmd += ' '
+        cmd = self._get_executable(kwargs)
         # Append the filename(s) that are run by the code
-        cmd += ' '.join(filenames)
+        cmd += filenames
         # If the user specified a config file, use it
         if kwargs['config_file'] is not None:
-            cmd += ' -c '+kwargs['config_file']
+            cmd += ['-c', kwargs['config_file']]
         # Add on any user specified parameters
-        for param in kwargs['config']:
-            if isinstance(kwargs['config'][param], bool):
-                if kwargs['config'][param]:
-                    val='Y'
-                else:
-                    val='N'
-            else:
-                val = kwargs['config'][param]
-            cmd += ' -'+param+' '+val
+        cmd += _get_config_args(kwargs['config'])
         return (cmd, kwargs)
     
-    def _run_cmd(self, this_cmd, store_output=False, xml_name=None, raise_error=True, frame=None):
+    def _get_executable(self, kwargs):
+        """
+        Get the arguments used to run the executable of a code (without any filenames
+        or config parameters).
+        
+        Parameters
+        ----------
+        kwargs: dict
+            Keyword arguments used to build the command, which must include either
+            a ``cmd`` or a ``code``
+        
+        Returns
+        -------
+        executable: list
+            List of arguments that run the code
+        """
+        if 'cmd' not in kwargs:
+            if kwargs['code'] not in codes:
+                raise AstromaticError(
+                    "You must either supply a valid astromatic 'code' name or "+
+                    "a 'cmd' to run")
+            return _resolve_cmd(codes[kwargs['code']])
+        return _resolve_cmd(kwargs['cmd'])
+    
+    def _run_cmd(self, this_cmd, store_output=False, xml_name=None, raise_error=True, frame=None,
+            verbose=None):
         """
         Execute a command to run an astromatic code. Since this allows a user to
         run any command on the host, it is recommended that no public
@@ -385,8 +513,9 @@ class Astromatic:
         
         Parameters
         ----------
-        this_cmd: str
-            The command to run from a subprocess. 
+        this_cmd: list
+            The command to run from a subprocess, as a list of arguments beginning with
+            the executable.
         store_output: bool (optional)
             Whether to store the output and return it to the user or print the output
             to the screen.
@@ -396,6 +525,11 @@ class Astromatic:
         raise_error: bool
             If ``raise_error==True``, python will raise an error if the 
             astromatic code fails due to an error
+        frame: str (optional)
+            Frame of the image that is being run (used to find the xml file for the frame)
+        verbose: bool (optional)
+            If ``verbose==False`` and ``store_output==False`` the output of the code is
+            discarded. Defaults to ``Astromatic.verbose``.
         
         Returns
         -------
@@ -405,8 +539,9 @@ class Astromatic:
             - error_msg: str
                 If there is an error and the user is storing the output or exporting XML metadata,
                 ``error_msg`` will contain the error message generated by the code
-            - output: str
-                If ``store_output==True`` the output of the program execution is
+            - output: list
+                If ``store_output==True`` the lines output by the program execution
+                (up to and including the first error message, if there is one) are
                 stored in the ``output`` value.
             - warnings: str
                 If the WRITE_XML parameter is ``True`` then a table of warnings detected
@@ -414,56 +549,64 @@ class Astromatic:
         """
         result = {'status':'success'}
         # Run code
-        logger.info('cmd:\n{0}\n'.format(this_cmd))
+        logger.info('cmd:\n{0}\n'.format(' '.join(this_cmd)))
         if store_output:
-            p = subprocess.Popen(this_cmd, shell=True, stdout=subprocess.PIPE, 
-                stderr=subprocess.STDOUT)
-            output = p.stdout.readlines()
-            result['output'] = output
-            for line in output:
+            p = subprocess.Popen(this_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            # Read the output as it is generated so that an error is detected
+            # as soon as it occurs
+            output = []
+            for line in iter(p.stdout.readline, b''):
+                if 'error_msg' in result:
+                    # The rest of the output is read (but not stored) so that the
+                    # code can run to completion without blocking on a full pipe
+                    continue
+                line = line.decode('utf-8', 'replace')
+                output.append(line)
                 if 'error' in line.lower():
                     result['status'] = 'error'
                     result['error_msg'] = line
-                    break
+            p.stdout.close()
+            if p.wait()!=0:
+                result['status'] = 'error'
+            result['output'] = output
         else:
-            status = subprocess.call(this_cmd, shell=True)
+            if verbose is None:
+                verbose = self.verbose
+            if verbose:
+                status = subprocess.call(this_cmd)
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    status = subprocess.call(this_cmd, stdout=devnull, stderr=subprocess.STDOUT)
             if status>0:
                 result['status'] = 'error'
-                if xml_name is not None:
-                    from astropy.io.votable import parse
-                    votable = parse(xml_name)
-                    for param in votable.resources[0].resources[0].params:
-                        if param.name=='Error_Msg':
-                            result['error_msg'] = param.value
-        # Log any warnings generated by the astromatic code
+        # Without an xml file there is nothing else to check if the code succeeded
+        if xml_name is None and result['status']=='success':
+            return result
+        # Log any warnings (and errors) generated by the astromatic code
         if xml_name is not None:
-            # SExtractor logs have a '-1' added to the filename and also
-            # stream the output catalog to the votable. Since the output may
-            # be a FITS_LDAC file, astropy does not rad this properly and it
-            # causes the read to crash. This code removes the link to the FITS_LDAC file
+            # Logs for individual frames have the frame added to the filename
             if frame is not None:
                 xml_name = xml_name.replace('.xml','-{0}.xml'.format(frame))
+            # SExtractor streams the output catalog to the votable. Since the output may
+            # be a FITS_LDAC file, astropy does not read this properly and it
+            # causes the read to crash, so the link to the catalog is removed
             if self.code == 'SExtractor':
-                f = open(xml_name, 'r')
-                all_lines = f.readlines()
-                f.close()
-                f = open(xml_name, 'w')
-                for line in all_lines:
-                    if '<fits' not in line.lower():
-                        f.write(line)
-                    elif '</DATA>' in line.upper():
-                        f.write('</DATA>\n')
-                f.close()
-            
-            from astropy.table import Table
-            from astropy.io.votable import parse
-            # Sometimes the xml file does not fit the VOTABLE standard,
-            # so we mask the invalid parameters
-            votable = parse(xml_name, invalid='mask', pedantic=False)
-            result['warnings'] = Table.read(votable, table_id='Warnings', format='votable')
+                _strip_fits_stream(xml_name)
+            # Mask the invalid parameters and ignore any problems with the VOTABLE standard.
+            # Only the data of the 'Warnings' table is read, which skips the large
+            # tables (such as the SCAMP field and group tables)
+            votable = parse(xml_name, table_id='Warnings', **_parse_kwargs)
+            # If the output of the code wasn't stored, get the error message from the xml file
+            if result['status']=='error' and 'error_msg' not in result:
+                for param in votable.resources[0].resources[0].params:
+                    if param.name=='Error_Msg':
+                        result['error_msg'] = param.value
+            result['warnings'] = votable.get_table_by_id('Warnings').to_table()
             # Fill in the masked values (otherwise there are problems with 
             # pipeline pickling)
             result['warnings'] = result['warnings'].filled(0)
+            if self.compress_xml:
+                xml_name = _gzip_file(xml_name)
             result['warnings'].meta['filename'] = xml_name
         # Raise an Exception if appropriate
         if result['status'] == 'error' and raise_error:
@@ -473,7 +616,7 @@ class Astromatic:
             raise AstromaticError(error_msg)
         return result
     
-    def run(self, filenames, store_output=False, raise_error=True, **kwargs):
+    def run(self, filenames, store_output=False, raise_error=True, verbose=None, **kwargs):
         """
         Build the command and run the code with a given set of options. If one of the
         keyword arguments is ``store_output=True`` the output of the code is returned,
@@ -489,6 +632,10 @@ class Astromatic:
         raise_error: bool (optional)
             If ``raise_error==True``, python will raise an error if the 
             astromatic code fails due to an error
+        verbose: bool (optional)
+            If ``verbose==False`` and ``store_output==False`` the output of the code is
+            discarded instead of being printed to the screen. Defaults to
+            ``Astromatic.verbose``.
         **kwargs: keyword arguments
             The following are optional keyword arguments that may be used:
                 - code: str
@@ -522,14 +669,88 @@ class Astromatic:
         else:
             xml_name = None
         
-        return self._run_cmd(this_cmd, store_output, xml_name, raise_error)
+        return self._run_cmd(this_cmd, store_output, xml_name, raise_error, verbose=verbose)
+    
+    def _run_one_frame(self, frame, this_cmd, frame_indices, xml_idx, xml_name, raise_error,
+            verbose=None):
+        """
+        Modify a command to include a given frame and run the code on that frame.
+        
+        Parameters
+        ----------
+        frame: int
+            Frame of the multi-extension file(s) to run
+        this_cmd: list
+            Command built by ``Astromatic.build_cmd`` without any frames specified
+        frame_indices: list
+            Indices of the arguments in ``this_cmd`` (image, flag and weight map
+            filenames) that need the frame added
+        xml_idx: int
+            Index of the xml filename in ``this_cmd`` (or ``None`` if no xml file
+            is generated)
+        xml_name: str
+            Name of the xml file generated by the code (or ``None`` if one is not generated)
+        raise_error: bool
+            If ``raise_error==True``, python will raise an error if the 
+            astromatic code fails due to an error
+        verbose: bool (optional)
+            Whether or not to print the output of the code. Defaults to
+            ``Astromatic.verbose``.
+        
+        Returns
+        -------
+        frame: int
+            The frame that was run
+        result: dict
+            Result of the astromatic code execution for the given frame
+        """
+        frame_str = '['+str(frame)+']'
+        new_cmd = list(this_cmd)
+        # Convert all multi-extension files to filenames with the same frame specified
+        for idx in frame_indices:
+            new_cmd[idx] = this_cmd[idx]+frame_str
+        # Each frame writes to its own xml file, so frames running at the same time
+        # never write to the same file
+        if xml_idx is not None:
+            new_cmd[xml_idx] = xml_name.replace('.xml', '-'+str(frame)+'.xml')
+        # Run the code
+        result = self._run_cmd(new_cmd, False, xml_name, raise_error, frame=str(frame),
+            verbose=verbose)
+        return frame, result
+    
+    def _is_all_frames(self, filename, frames):
+        """
+        Check whether a list of frames contains every image extension in a
+        multi-extension FITS file.
+        
+        Parameters
+        ----------
+        filename: str
+            Name of the multi-extension FITS file
+        frames: list
+            List of frames to check
+        
+        Returns
+        -------
+        is_all_frames: bool
+            ``True`` if ``frames`` contains every image extension of ``filename``
+        """
+        try:
+            hdulist = fits.open(filename)
+        except IOError:
+            return False
+        image_frames = [idx for idx, hdu in enumerate(hdulist) 
+            if idx>0 and hdu.is_image and hdu.header.get('NAXIS', 0)>0]
+        hdulist.close()
+        return set(image_frames)==set(frames)
     
     def run_frames(self, filenames, code=None, frames=[1], raise_error=True,
-            **kwargs):
+            max_workers=1, batch_frames=False, verbose=None, **kwargs):
         """
         If the user is running sextractor on an individual frame, this command will
         correctly add the frame to the image filename, flag filename, and weightmap filename
-        (if they are specified).
+        (if they are specified). If ``max_workers>1``, up to ``max_workers`` frames are
+        run at the same time.
         
         Parameters
         ----------
@@ -543,6 +764,27 @@ class Astromatic:
         raise_error: bool (optional)
             If ``raise_error==True``, python will raise an error if the 
             astromatic code fails due to an error
+        max_workers: int (optional)
+            Maximum number of frames to run at the same time. The default is ``1``, which
+            runs the frames one at a time. Only the xml file is given a different name
+            for each frame, so frames should only be run at the same time if all of the
+            other output files (such as ``CATALOG_NAME`` or SWarp's ``IMAGEOUT_NAME``)
+            are different for each frame. SExtractor and SWarp also use multiple
+            threads themselves, so ``max_workers`` should usually be much smaller than
+            the number of CPUs. Running frames at the same time requires the 
+            ``concurrent.futures`` module (the 'futures' package in Python 2).
+        batch_frames: bool (optional)
+            If ``batch_frames==True`` and SExtractor is run on every image extension
+            of a multi-extension file, SExtractor is run once on the entire file
+            (which loops over all of the extensions itself) instead of once for each frame.
+            In this case a single multi-extension catalog and xml file are created,
+            and the ``frame`` of each warning is set to ``0`` because SExtractor does
+            not record the frame that generated it.
+            If ``frames`` is only a subset of the image extensions each frame is run
+            separately. The default is ``False``.
+        verbose: bool (optional)
+            If ``verbose==False`` the output of the code is discarded instead of being
+            printed to the screen. Defaults to ``Astromatic.verbose``.
         **kwargs: keyword arguments
             The following are optional keyword arguments that may be used:
                 - config: dict (optional)
@@ -569,6 +811,10 @@ class Astromatic:
         # Set the code to run
         if code is None:
             code = self.code
+        if max_workers>1 and ThreadPoolExecutor is None:
+            warnings.warn("Running frames at the same time requires 'concurrent.futures', "
+                "running the frames one at a time")
+            max_workers = 1
         # Format any filenames that may need a frame specified
         if 'config' not in kwargs:
             kwargs['config'] = self.config
@@ -589,41 +835,67 @@ class Astromatic:
             xml_name = None
         # Build the command
         this_cmd, kwargs = self.build_cmd(filenames, code=code, **kwargs)
+        if not isinstance(filenames, list):
+            filenames = [filenames]
+        
+        # SExtractor can process all of the frames in a single execution. SWarp is
+        # not batched since running it on multiple frames would stack them together
+        if (batch_frames and code=='SExtractor' and len(frames)>1 and
+                self._is_all_frames(filenames[0], frames)):
+            result = self._run_cmd(this_cmd, False, xml_name, raise_error, verbose=verbose)
+            # Return the same keys as running each frame separately. SExtractor
+            # doesn't record which frame generated each warning, so the frame is 0
+            if 'warnings' in result and len(result['warnings'])>0:
+                result['warnings']['frame'] = 0
+            else:
+                result['warnings'] = None
+            return result
+        
+        # Find the arguments that need to be changed for each frame. The filenames
+        # come right after the executable, so a config value that happens to be the
+        # same as one of the filenames is left unchanged
+        file_idx = len(self._get_executable(kwargs))
+        frame_indices = list(range(file_idx, file_idx+len(filenames)))
+        # The flag image, weight map and xml file are the values that follow their
+        # config parameter names
+        config_idx = file_idx+len(filenames)
+        param_indices = dict([(arg, idx+1) for idx, arg in 
+            enumerate(this_cmd[config_idx:], config_idx) if arg in _frame_params])
+        if flag_img is not None:
+            frame_indices.append(param_indices['-FLAG_IMAGE'])
+        if weight_img is not None:
+            frame_indices.append(param_indices['-WEIGHT_IMAGE'])
+        xml_idx = None
+        if xml_name is not None:
+            xml_idx = param_indices['-XML_NAME']
+        
+        frame_args = (this_cmd, frame_indices, xml_idx, xml_name, raise_error, verbose)
+        if max_workers==1:
+            frame_results = dict([self._run_one_frame(frame, *frame_args) 
+                for frame in frames])
+        else:
+            # Run the code on each frame in a separate thread. Each thread spends
+            # nearly all of its time waiting on the astromatic subprocess for its frame
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(self._run_one_frame, frame, *frame_args)
+                    for frame in frames]
+            frame_results = dict([future.result() for future in futures])
         
-        # For each frame, modify the command to include the frames and run the code
-        all_warnings = None
+        warnings_list = []
         result = {'status': 'success'}
         for frame in frames:
-            new_cmd = this_cmd
-            frame_str = '['+str(frame)+']'
-            
-            # Convert all multi-extension files to filenames with the same frame specified
-            if not isinstance(filenames, list):
-                filenames = [filenames]
-            for filename in filenames:
-                new_cmd = new_cmd.replace(filename, filename+frame_str)
-            if flag_img is not None:
-                new_cmd = new_cmd.replace(flag_img, flag_img+frame_str)
-            if weight_img is not None:
-                new_cmd = new_cmd.replace(weight_img, weight_img+frame_str)
-            if xml_name is not None:
-                new_cmd = new_cmd.replace(xml_name, xml_name.replace(
-                    '.xml', '-'+str(frame)+'.xml'))
-            # Run the code
-            frame_result = self._run_cmd(new_cmd, False, xml_name, raise_error, frame=str(frame))
-            
-            # Combine all warnings into a single table
+            frame_result = frame_results[frame]
             if 'warnings' in frame_result and len(frame_result['warnings'])>0:
-                from astropy.table import vstack
-                warnings = frame_result['warnings']
-                warnings['frame'] = frame
-                if all_warnings is None:
-                    all_warnings = warnings
-                else:
-                    all_warnings = vstack([all_warnings, warnings])
+                frame_warnings = frame_result['warnings']
+                frame_warnings['frame'] = frame
+                warnings_list.append(frame_warnings)
             if frame_result['status'] != 'success':
                 result.update(frame_result)
-        result['warnings'] = all_warnings
+        # Combine all warnings into a single table
+        if len(warnings_list)>0:
+            result['warnings'] = vstack(warnings_list)
+        else:
+            result['warnings'] = None
         return result
     
     def get_version(self, cmd=None):
@@ -647,26 +919,176 @@ class Astromatic:
         """
         # Get the correct command for the given code (if one is not specified)
         if cmd is None:
-            if self.code not in codes:
+            if hasattr(self, 'cmd'):
+                cmd = self.cmd
+            elif self.code not in codes:
                 raise AstromaticError(
                     "You must either supply a valid astromatic 'code' name or a 'cmd'")
-            cmd = codes[self.code]
-        if cmd[-1]!=' ':
-            cmd += ' '
-        cmd += '-v'
-        try:
-            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, 
-                stderr=subprocess.STDOUT)
-        except:
-            raise AstromaticError("Unable to run '{0}'. "
-                "Please check that it is installed correctly".format(cmd))
-        for line in p.stdout.readlines():
-            line_split = line.split()
-            line_split = map(lambda x: x.lower(), line_split)
-            if 'version' in line_split:
-                version_idx = line_split.index('version')
-                version = line_split[version_idx+1]
-                date = line_split[version_idx+2]
-                date = date.lstrip('(').rstrip(')')
-                break
-        return version, date
\ No newline at end of file
+            else:
+                cmd = codes[self.code]
+        # The version of a code does not change while python is running, so
+        # each code is only run once to get its version
+        if cmd not in _versions:
+            _versions[cmd] = _probe_version(cmd)
+        return _versions[cmd]
+
+def _resolve_cmd(cmd):
+    """
+    Split a command into a list of arguments and find the full path of its executable
+    on the system PATH. Each command is only looked up once.
+    
+    Parameters
+    ----------
+    cmd: str
+        Command used to run a code. This may be the name of the code, a path to the
+        code, or include additional arguments
+    
+    Returns
+    -------
+    argv: list
+        List of arguments, beginning with the executable. If the executable can't be
+        found the name in ``cmd`` is used.
+    """
+    if cmd not in _resolved_cmds:
+        # The user may have specified a command with its own arguments. Backslashes
+        # are kept on Windows, where they separate the directories in a path
+        argv = shlex.split(cmd, posix=(os.name!='nt'))
+        argv[0] = os.path.expanduser(argv[0])
+        executable = _which(argv[0])
+        if executable is not None:
+            argv[0] = executable
+        _resolved_cmds[cmd] = argv
+    return list(_resolved_cmds[cmd])
+
+def _format_config_value(val):
+    """
+    Convert a config parameter value to a command line argument
+    """
+    if type(val) is bool:
+        return _config_bools[val]
+    return str(val)
+
+def _get_config_args(config):
+    """
+    Get the command line arguments for a dictionary of config parameters. The arguments
+    for each set of config parameters are only built once, since pipeline steps usually
+    run a code many times with the same config, where only the parameters in 
+    ``_varying_params`` change. Those parameters are filled in each time.
+    
+    Parameters
+    ----------
+    config: dict
+        Dictionary of configuration options to pass in the command line
+    
+    Returns
+    -------
+    args: list
+        List of command line arguments, in the same order as ``config``
+    """
+    # The type of each value is included in the key because values like ``True`` and
+    # ``1`` are equal but have different command line arguments
+    try:
+        key = tuple([(param, None, None) if param in _varying_params 
+            else (param, type(val), val) for param, val in config.items()])
+        template = _config_args_cache.get(key)
+    except TypeError:
+        # Config values that cannot be hashed are never cached
+        key = None
+        template = None
+    if template is not None:
+        args, varying = template
+        args = list(args)
+        for idx, param in varying:
+            args[idx] = _format_config_value(config[param])
+        return args
+    args = []
+    varying = []
+    for param, val in config.items():
+        if param in _varying_params:
+            varying.append((len(args)+1, param))
+        args += ['-'+param, _format_config_value(val)]
+    if key is not None:
+        if len(_config_args_cache)>=_config_args_cache_size:
+            _config_args_cache.clear()
+        _config_args_cache[key] = (tuple(args), varying)
+    return args
+
+def _probe_version(cmd):
+    """
+    Run an astromatic code to get its version. This should only be called by
+    `Astromatic.get_version`, which stores the result for each command.
+    
+    Parameters
+    ----------
+    cmd: str
+        Command used to run the code
+    
+    Returns
+    -------
+    version: str
+        Version of the specified astromatic code
+    date: str
+        Date associated with the specified astromatic code
+    """
+    argv = _resolve_cmd(cmd)+['-v']
+    try:
+        p = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+    except:
+        raise AstromaticError("Unable to run '{0}'. "
+            "Please check that it is installed correctly".format(cmd))
+    for line in p.stdout.readlines():
+        line_split = [x.lower() for x in line.split()]
+        if 'version' in line_split:
+            version_idx = line_split.index('version')
+            version = line_split[version_idx+1]
+            date = line_split[version_idx+2]
+            date = date.lstrip('(').rstrip(')')
+            return version, date
+    raise AstromaticError("Unable to find the version of '{0}'".format(cmd))
+
+def _strip_fits_stream(xml_name):
+    """
+    Remove the ``<DATA>`` elements that link to a FITS catalog from an xml file
+    generated by SExtractor, so that the file can be read by astropy.
+    
+    Parameters
+    ----------
+    xml_name: str
+        Name of the xml file to modify
+    """
+    with open(xml_name, 'rb') as f:
+        xml = f.read()
+    fits_idx = xml.find(b'<FITS')
+    if fits_idx<0:
+        return
+    while fits_idx>=0:
+        start = xml.rfind(b'<DATA', 0, fits_idx)
+        end = xml.find(b'</DATA>', fits_idx)
+        if start<0 or end<0:
+            break
+        xml = xml[:start]+xml[end+len(b'</DATA>'):]
+        fits_idx = xml.find(b'<FITS', start)
+    with open(xml_name, 'wb') as f:
+        f.write(xml)
+
+def _gzip_file(filename):
+    """
+    Compress a file with gzip and remove the original file.
+    
+    Parameters
+    ----------
+    filename: str
+        Name of the file to compress
+    
+    Returns
+    -------
+    gz_name: str
+        Name of the compressed file (``filename`` with '.gz' appended)
+    """
+    gz_name = filename+'.gz'
+    with open(filename, 'rb') as f_in:
+        with gzip.open(gz_name, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    os.remove(filename)
+    return gz_name
@@ -1,3 +1,5 @@
+import os
+
 def get_package_data():
     return {
-        _ASTROPY_PACKAGE_NAME_ + '.tests': ['coveragerc']}
+        _ASTROPY_PACKAGE_NAME_ + '.tests': ['coveragerc', os.path.join('data', '*.xml')]}
@@ -5,8 +5,10 @@ else:
     import __builtin__ as builtins
 import os
 import subprocess
+import shutil
 from astropy.extern import six
 import copy
+import hashlib
 from astropy.tests.helper import pytest
 from collections import OrderedDict
 
@@ -14,7 +16,18 @@ from astromatic_wrapper import api
 from astromatic_wrapper.utils import ldac, pipeline
 
 def setup_module(module):
-    module.data_path = os.path.join(os.path.relpath(__file__), 'data')
+    module.data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    # Don't search the PATH for the astromatic codes, so that the commands built in the
+    # tests don't depend on the codes installed on the system
+    module.which = api._which
+    api._which = lambda cmd: None
+    api._resolved_cmds.clear()
+
+def teardown_module(module):
+    # Restore the functions mocked by this module so they don't leak into other tests
+    api._which = module.which
+    api._resolved_cmds.clear()
+    api.Astromatic._run_cmd = run_cmd
 
 def mock_subprocess_call(return_val):
     # Mock the subprocess so that it doesn't actually execute subprocess.call,
@@ -30,6 +43,9 @@ def mock_raw_input(return_val):
         return return_val
     return f
 
+# Keep a reference to the unmocked method to test running a command
+run_cmd = api.Astromatic._run_cmd
+
 def mock_run_cmd(*args, **kwargs):
     return {'status': 'error', 'args': args[1:], 'kwargs':kwargs}
 
@@ -72,7 +88,7 @@ class TestAstromatic:
         cmd_result = 'sex test.fits -c {0} -CATALOG_NAME {1} '.format(
             sex_kwargs['config_file'], sex_kwargs['config']['CATALOG_NAME'])
         cmd_result += '-CATALOG_TYPE FITS_LDAC -PARAMETERS_NAME default.path -FILTER N'
-        assert sextractor.build_cmd('test.fits')[0]==cmd_result
+        assert sextractor.build_cmd('test.fits')[0]==cmd_result.split()
         
         kwargs = copy.deepcopy(sex_kwargs)
         sextractor = api.Astromatic('SExtractor')
@@ -81,12 +97,41 @@ class TestAstromatic:
         kwargs['params'] = ['X_WORLD', 'Y_WORLD', 'MAG_AUTO']
         cmd_result = 'path/to/sex test.fits -CATALOG_NAME {0} '.format(
             sex_kwargs['config']['CATALOG_NAME'])
+        param_name = os.path.join(str(tmpdir), 'sex-{0}.param'.format(
+            hashlib.sha1(b'X_WORLD\nY_WORLD\nMAG_AUTO\n').hexdigest()[:12]))
         cmd_result += '-CATALOG_TYPE FITS_LDAC -PARAMETERS_NAME {0} -FILTER N'.format(
-            os.path.join(str(tmpdir), 'sex.param'))
-        assert sextractor.build_cmd('test.fits', **kwargs)[0]==cmd_result
+            param_name)
+        assert sextractor.build_cmd('test.fits', **copy.deepcopy(kwargs))[0]==cmd_result.split()
+        with open(param_name) as f:
+            assert f.read()=='X_WORLD\nY_WORLD\nMAG_AUTO\n'
+        # The parameter file is not rewritten if the parameters have not changed
+        mtime = os.path.getmtime(param_name)
+        os.utime(param_name, (mtime-100, mtime-100))
+        assert sextractor.build_cmd('test.fits', **copy.deepcopy(kwargs))[0]==cmd_result.split()
+        assert os.path.getmtime(param_name)==mtime-100
+    
+    def test_config_args(self):
+        api._config_args_cache.clear()
+        config = OrderedDict([
+            ('CATALOG_NAME', 'img1.cat'),
+            ('CATALOG_TYPE', 'FITS_LDAC'),
+            ('FILTER', True),
+            ('DETECT_MINAREA', 1),
+        ])
+        assert api._get_config_args(config)==['-CATALOG_NAME', 'img1.cat', 
+            '-CATALOG_TYPE', 'FITS_LDAC', '-FILTER', 'Y', '-DETECT_MINAREA', '1']
+        # Changing a filename reuses the cached arguments
+        config['CATALOG_NAME'] = 'img2.cat'
+        assert api._get_config_args(config)==['-CATALOG_NAME', 'img2.cat', 
+            '-CATALOG_TYPE', 'FITS_LDAC', '-FILTER', 'Y', '-DETECT_MINAREA', '1']
+        assert len(api._config_args_cache)==1
+        # True and 1 are different command line values
+        config['FILTER'] = 1
+        assert api._get_config_args(config)==['-CATALOG_NAME', 'img2.cat', 
+            '-CATALOG_TYPE', 'FITS_LDAC', '-FILTER', '1', '-DETECT_MINAREA', '1']
+        assert len(api._config_args_cache)==2
     
-    def test_run_frames(self, tmpdir):
-        import subprocess
+    def test_run_frames(self, tmpdir, monkeypatch):
         import types
         
         sex_kwargs = {
@@ -99,7 +144,7 @@ class TestAstromatic:
                 ('FLAG_IMAGE', 'test.dqmask.fits')
             ]),
         }
-        subprocess.call = mock_subprocess_call(0)
+        monkeypatch.setattr(subprocess, 'call', mock_subprocess_call(0))
         sextractor = api.Astromatic(**sex_kwargs)
         sextractor._run_cmd = types.MethodType(mock_run_cmd, sextractor)
         frame_result = sextractor.run_frames('test.fits', frames=[2])
@@ -108,20 +153,142 @@ class TestAstromatic:
             #        ' test.wtmap.fits[2] -CATALOG_NAME test.fits[2] '
             #        '-FLAG_IMAGE test.dqmask.fits[2]',
             'args': (
-                'sex test.fits[2] -CATALOG_NAME test.fits[2] -PARAMETERS_NAME default.path '
-                    '-WEIGHT_IMAGE test.wtmap.fits[2] -FLAG_IMAGE test.dqmask.fits[2]',
+                ['sex', 'test.fits[2]', '-CATALOG_NAME', 'test.fits', 
+                    '-PARAMETERS_NAME', 'default.path', 
+                    '-WEIGHT_IMAGE', 'test.wtmap.fits[2]', 
+                    '-FLAG_IMAGE', 'test.dqmask.fits[2]'],
                 False,
                 None,
                 True),
-            'kwargs': {'frame': '2'},
+            'kwargs': {'frame': '2', 'verbose': None},
             'status': 'error',
             'warnings': None
         }
         assert frame_result==result
+        
+        # Frames run in parallel should be combined in the order they were given
+        frame_result = sextractor.run_frames('test.fits', frames=[3, 2], max_workers=2)
+        assert frame_result==result
+    
+    def test_run_frames_batch(self, tmpdir):
+        import types
+        import numpy as np
+        from astropy.io import fits
+        
+        filename = os.path.join(str(tmpdir), 'test.fits')
+        hdulist = fits.HDUList([fits.PrimaryHDU()]+
+            [fits.ImageHDU(np.zeros((2,2))) for n in range(2)])
+        hdulist.writeto(filename)
+        sex_kwargs = {
+            'code': 'SExtractor',
+            'temp_path': str(tmpdir),
+            'config': OrderedDict([
+                ('CATALOG_NAME', 'test.cat'),
+                ('PARAMETERS_NAME', 'default.path'),
+            ]),
+        }
+        sextractor = api.Astromatic(**sex_kwargs)
+        sextractor._run_cmd = types.MethodType(mock_run_cmd, sextractor)
+        # All of the frames are run in a single execution
+        frame_result = sextractor.run_frames(filename, frames=[1,2], batch_frames=True)
+        cmd = 'sex {0} -CATALOG_NAME test.cat -PARAMETERS_NAME default.path'.format(filename)
+        assert frame_result=={
+            'args': (cmd.split(), False, None, True),
+            'kwargs': {'verbose': None},
+            'status': 'error',
+            'warnings': None
+        }
+        # Warnings have the same columns as warnings from individual frames
+        def mock_warnings_run_cmd(self, *args, **kwargs):
+            from astropy.table import Table
+            return {'status': 'success', 'warnings': Table([['a warning']], names=['Msg'])}
+        batch_sex = api.Astromatic(**sex_kwargs)
+        batch_sex._run_cmd = types.MethodType(mock_warnings_run_cmd, batch_sex)
+        frame_result = batch_sex.run_frames(filename, frames=[1,2], batch_frames=True)
+        assert frame_result['warnings'].colnames==['Msg', 'frame']
+        assert list(frame_result['warnings']['frame'])==[0]
+        # A subset of frames is still run frame by frame
+        frame_result = sextractor.run_frames(filename, frames=[2], batch_frames=True)
+        assert frame_result['kwargs']=={'frame': '2', 'verbose': None}
+    
+    def test_run_cmd_output(self):
+        sextractor = api.Astromatic('SExtractor')
+        this_cmd = [sys.executable, '-c', 
+            "print('running'); print('*ERROR*: no image'); print('exiting')"]
+        result = run_cmd(sextractor, this_cmd, store_output=True, raise_error=False)
+        assert result['status']=='error'
+        assert result['error_msg']=='*ERROR*: no image\n'
+        assert result['output']==['running\n', '*ERROR*: no image\n']
+        with pytest.raises(api.AstromaticError):
+            run_cmd(sextractor, this_cmd, store_output=True)
     
-    def test_version(self):
-        import subprocess
+    def test_run_cmd_output_complete(self, tmpdir):
+        sextractor = api.Astromatic('SExtractor')
+        # The code keeps running after a line with an error
+        filename = os.path.join(str(tmpdir), 'done.txt')
+        this_cmd = [sys.executable, '-c', 
+            "import sys; sys.stdout.write('Measuring: 0 errors flagged\\n'); "
+            "[sys.stdout.write('line\\n') for i in range(10000)]; sys.stdout.flush(); "
+            "open({0!r}, 'w').close()".format(filename)]
+        result = run_cmd(sextractor, this_cmd, store_output=True, raise_error=False)
+        assert os.path.isfile(filename)
+        assert result['output']==['Measuring: 0 errors flagged\n']
+        # A non-zero exit status is an error, even without an error message
+        this_cmd = [sys.executable, '-c', "import sys; print('running'); sys.exit(2)"]
+        result = run_cmd(sextractor, this_cmd, store_output=True, raise_error=False)
+        assert result['status']=='error'
+        assert 'error_msg' not in result
+        # Output that isn't valid UTF-8 is decoded with replacement characters
+        this_cmd = [sys.executable, '-c',
+            "import sys; getattr(sys.stdout, 'buffer', sys.stdout).write(b'bad \\xff\\n')"]
+        result = run_cmd(sextractor, this_cmd, store_output=True, raise_error=False)
+        assert result['status']=='success'
+        assert result['output']==[u'bad \ufffd\n']
+    
+    def test_run_cmd_xml(self, tmpdir):
+        # SExtractor xml files link to the output catalog, which astropy can't read
+        xml_name = os.path.join(str(tmpdir), 'test.sex.log.xml')
+        shutil.copy(os.path.join(data_path, 'test.sex.log.xml'), xml_name)
+        sextractor = api.Astromatic('SExtractor')
+        result = run_cmd(sextractor, [sys.executable, '-c', 'pass'], xml_name=xml_name)
+        assert result['status']=='success'
+        assert list(result['warnings']['Msg'])==[
+            'FLAG_IMAGE has a different size', 'Not enough memory for the deblending']
+        assert result['warnings'].meta['filename']==xml_name
+        with open(xml_name) as f:
+            assert '<FITS' not in f.read()
+        
+        # The error message is read from the xml file
+        shutil.copy(os.path.join(data_path, 'test.sex.log.xml'), xml_name)
+        this_cmd = [sys.executable, '-c', 'import sys; sys.exit(1)']
+        result = run_cmd(sextractor, this_cmd, xml_name=xml_name, raise_error=False)
+        assert result['status']=='error'
+        assert result['error_msg']=='*Error*: cannot open test.fits[9]'
+        assert len(result['warnings'])==2
+    
+    def test_run_cmd_compress_xml(self, tmpdir):
+        xml_name = os.path.join(str(tmpdir), 'test.sex.log.xml')
+        shutil.copy(os.path.join(data_path, 'test.sex.log.xml'), xml_name)
+        sextractor = api.Astromatic('SExtractor', compress_xml=True)
+        result = run_cmd(sextractor, [sys.executable, '-c', 'pass'], xml_name=xml_name)
+        assert len(result['warnings'])==2
+        assert os.path.isfile(xml_name+'.gz')
+        assert not os.path.exists(xml_name)
+        assert result['warnings'].meta['filename']==xml_name+'.gz'
+    
+    def test_run_cmd_verbose(self, capfd):
+        this_cmd = [sys.executable, '-c', "print('running')"]
+        sextractor = api.Astromatic('SExtractor')
+        assert run_cmd(sextractor, this_cmd)=={'status': 'success'}
+        assert capfd.readouterr()[0]=='running\n'
+        sextractor = api.Astromatic('SExtractor', verbose=False)
+        assert run_cmd(sextractor, this_cmd)=={'status': 'success'}
+        assert capfd.readouterr()[0]==''
+    
+    def test_version(self, monkeypatch):
+        calls = []
         def mock_subprocess_popen(*args, **kwargs):
+            calls.append(args)
             class stdout:
                 def readlines(self):
                     return ['SExtractor version 2.19.5 (2015-04-30)\n']
@@ -129,12 +296,52 @@ class TestAstromatic:
                 def __init__(self):
                     self.stdout = stdout()
             return popen()
-        subprocess.Popen = mock_subprocess_popen
+        monkeypatch.setattr(subprocess, 'Popen', mock_subprocess_popen)
+        api._versions.clear()
         sextractor = api.Astromatic('SExtractor')
         assert sextractor.get_version()==('2.19.5', '2015-04-30')
+        # The version is only looked up once for each command
+        assert sextractor.get_version()==('2.19.5', '2015-04-30')
+        assert calls==[(['sex', '-v'],)]
+        sextractor = api.Astromatic('SExtractor', cmd='path/to/sex')
+        assert sextractor.get_version()==('2.19.5', '2015-04-30')
+        assert calls[-1]==(['path/to/sex', '-v'],)
 
 api.Astromatic._run_cmd = mock_run_cmd
 
+def test_resolve_cmd(monkeypatch):
+    calls = []
+    def mock_which(cmd):
+        calls.append(cmd)
+        return '/usr/local/bin/'+cmd
+    monkeypatch.setattr(api, '_which', mock_which)
+    monkeypatch.setattr(api, '_resolved_cmds', {})
+    assert api._resolve_cmd('sex')==['/usr/local/bin/sex']
+    # The executable is only searched for once
+    argv = api._resolve_cmd('sex')
+    assert argv==['/usr/local/bin/sex']
+    assert calls==['sex']
+    # Modifying the returned arguments doesn't change the stored command
+    argv.append('img.fits')
+    assert api._resolve_cmd('sex')==['/usr/local/bin/sex']
+    assert api._resolve_cmd('mpirun -np 2 scamp')==['/usr/local/bin/mpirun', 
+        '-np', '2', 'scamp']
+    # Backslashes in Windows paths are kept
+    monkeypatch.setattr(api, '_which', lambda cmd: None)
+    monkeypatch.setattr(os, 'name', 'nt')
+    assert api._resolve_cmd('C:\\astromatic\\sex.exe')==['C:\\astromatic\\sex.exe']
+
+def test_gzip_file(tmpdir):
+    import gzip
+    filename = os.path.join(str(tmpdir), 'test.xml')
+    with open(filename, 'w') as f:
+        f.write('<VOTABLE></VOTABLE>\n')
+    gz_name = api._gzip_file(filename)
+    assert gz_name==filename+'.gz'
+    assert not os.path.exists(filename)
+    with gzip.open(gz_name, 'rb') as f:
+        assert f.read()==b'<VOTABLE></VOTABLE>\n'
+
 def test_run_sex(tmpdir):
     paths = {
         'temp': os.path.join(str(tmpdir), 'temp'),
@@ -159,14 +366,17 @@ def test_run_sex(tmpdir):
     cmd += '-WRITE_XML Y -XML_NAME {0}/0.sex.log.xml'.format(paths['log'])
     cmd_result = {
         'args': (
-            cmd,
+            cmd.split(),
             False,
             '{0}/0.sex.log.xml'.format(paths['log']),
             True),
-        'kwargs': {},
+        'kwargs': {'verbose': None},
         'status': 'error'
     }
     assert result==cmd_result
+    # The user's keyword arguments are not modified
+    assert list(kwargs.keys())==['config']
+    assert list(kwargs['config'].keys())==['PARAMETERS_NAME']
     
     result = api.run_sex(pipe,0,files, kwargs, [1])
     cmd = 'sex img.fits[1] -PARAMETERS_NAME default.path -CATALOG_NAME img.cat '
@@ -174,11 +384,11 @@ def test_run_sex(tmpdir):
     cmd += '-WRITE_XML Y -XML_NAME {0}/0.sex.log-1.xml'.format(paths['log'])
     cmd_result = {
         'args': (
-            cmd,
+            cmd.split(),
             False,
             '{0}/0.sex.log.xml'.format(paths['log']),
             False),
-        'kwargs': {'frame': '1'},
+        'kwargs': {'frame': '1', 'verbose': None},
         'status': 'error',
         'warnings': None
     }
@@ -197,11 +407,11 @@ def test_run_scamp(tmpdir):
     cmd += '-WRITE_XML Y -XML_NAME {0}/0.scamp.log.xml'.format(paths['log'])
     cmd_result = {
         'args': (
-            cmd,
+            cmd.split(),
             False,
             '{0}/0.scamp.log.xml'.format(paths['log']),
             True),
-        'kwargs': {},
+        'kwargs': {'verbose': None},
         'status': 'error'
     }
     assert result==cmd_result
@@ -219,11 +429,11 @@ def test_run_swarp(tmpdir):
     cmd += '-WRITE_XML Y -XML_NAME {0}/0.swarp.log.xml'.format(paths['log'])
     cmd_result = {
         'args': (
-            cmd,
+            cmd.split(),
             False,
             '{0}/0.swarp.log.xml'.format(paths['log']),
             True),
-        'kwargs': {},
+        'kwargs': {'verbose': None},
         'status': 'error'
     }
     assert result==cmd_result
@@ -233,11 +443,11 @@ def test_run_swarp(tmpdir):
     cmd += '-WRITE_XML Y -XML_NAME {0}/0.swarp.log-1.xml'.format(paths['log'])
     cmd_result = {
         'args': (
-            cmd,
+            cmd.split(),
             False,
             '{0}/0.swarp.log.xml'.format(paths['log']),
             False),
-        'kwargs': {'frame': '1'},
+        'kwargs': {'frame': '1', 'verbose': None},
         'status': 'error',
         'warnings': None
     }
@@ -256,11 +466,44 @@ def test_run_psfex(tmpdir):
     cmd += '-WRITE_XML Y -XML_NAME {0}/0.psfex.log.xml'.format(paths['log'])
     cmd_result = {
         'args': (
-            cmd,
+            cmd.split(),
             False,
             '{0}/0.psfex.log.xml'.format(paths['log']),
             True),
-        'kwargs': {},
+        'kwargs': {'verbose': None},
         'status': 'error'
     }
-    assert result==cmd_result
\ No newline at end of file
+    assert result==cmd_result
+
+def test_run_batch(tmpdir, monkeypatch):
+    paths = {
+        'temp': os.path.join(str(tmpdir), 'temp'),
+        'log': os.path.join(str(tmpdir), 'log')
+    }
+    setattr(builtins,'raw_input', mock_raw_input('y'))
+    setattr(builtins,'input', mock_raw_input('y'))
+    pipe = pipeline.Pipeline(paths=paths, build_paths = {})
+    tasks = [(api.run_psfex, (pipe, step_id, ['cat{0}.fits'.format(step_id)]), {})
+        for step_id in range(3)]
+    results = api.run_batch(tasks, 2)
+    assert [result['args'][0][1] for result in results]==['cat0.fits', 'cat1.fits', 'cat2.fits']
+    assert [result['args'][2] for result in results]==[
+        '{0}/{1}.psfex.log.xml'.format(paths['log'], step_id) for step_id in range(3)]
+    
+    # Frames in batched tasks are run serially
+    run_frames_kwargs = []
+    def mock_run_frames(self, *args, **kwargs):
+        run_frames_kwargs.append(kwargs)
+    monkeypatch.setattr(api.Astromatic, 'run_frames', mock_run_frames)
+    tasks = [(api.run_sex, (pipe, step_id, {'image': 'img{0}.fits'.format(step_id)}),
+        {'frames': [1, 2]}) for step_id in range(3)]
+    api.run_batch(tasks, 2)
+    assert run_frames_kwargs==[{'max_workers': 1}]*3
+    
+    # Without concurrent.futures the tasks are run one at a time
+    monkeypatch.setattr(api, 'ThreadPoolExecutor', None)
+    tasks = [(api.run_psfex, (pipe, step_id, ['cat{0}.fits'.format(step_id)]), {})
+        for step_id in range(2)]
+    with pytest.warns(UserWarning):
+        results = api.run_batch(tasks, 2)
+    assert [result['args'][0][1] for result in results]==['cat0.fits', 'cat1.fits']